@@ -5,22 +5,107 @@ Provides an HTTP API for running Semgrep static analysis on code files.
 Designed to be called by ghagga for security checks on PR file contents.
 """
 
-import json
+import asyncio
+import hashlib
 import os
+import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any
 
-from fastapi import FastAPI, HTTPException
+import ahocorasick
+import msgspec
+import yaml
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-app = FastAPI(title="Ghagga Semgrep Service", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the version probe so the first /health doesn't fork semgrep
+    get_semgrep_version()
+    yield
+
+
+app = FastAPI(title="Ghagga Semgrep Service", version="1.0.0", lifespan=lifespan)
 
 RULES_PATH = Path(__file__).parent / "rules.yml"
 
+# Resolve the semgrep executable once instead of a PATH search per run, and
+# disable its telemetry and registry version check: both add fixed (sometimes
+# network-bound) overhead to every invocation.
+SEMGREP_BIN = shutil.which("semgrep") or "semgrep"
+SEMGREP_BASE_ARGS = ["--metrics=off", "--disable-version-check"]
+
+# File writes release the GIL, so large batches are written concurrently.
+# Small batches stay serial: thread handoff costs more than a few writes.
+PARALLEL_WRITE_MIN_FILES = 16
+
+_write_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="scan-write")
+
+# Write scan workspaces to tmpfs when available (Linux containers, including
+# the Railway deploy) so the per-scan file churn never touches disk. Falls
+# back to the platform default temp dir otherwise.
+_TMPFS_DIR = "/dev/shm"
+SCAN_TMP_DIR = _TMPFS_DIR if os.path.isdir(_TMPFS_DIR) and os.access(_TMPFS_DIR, os.W_OK) else None
+
+# Cache scan results keyed by file contents + rules config, so repeated scans
+# of identical payloads (e.g. re-triggered PR checks) skip the semgrep run.
+SCAN_CACHE_SIZE = 2000
+SCAN_CACHE_TTL_S = 86400
+
+_scan_cache: TTLCache = TTLCache(maxsize=SCAN_CACHE_SIZE, ttl=SCAN_CACHE_TTL_S)
+_scan_cache_lock = threading.Lock()
+
+# Concurrent scan requests arriving within this window are coalesced into a
+# single semgrep invocation, amortising its startup + rule-parsing cost.
+BATCH_WINDOW_S = 0.05
+SCAN_TIMEOUT_S = 60
+
+# Small batches shouldn't get the full 60 s: the subprocess cap scales with
+# batch size (base + 1 s per file) so a hung scan of a few files fails fast,
+# while callers always wait at most SCAN_TIMEOUT_S.
+SCAN_TIMEOUT_BASE_S = 5
+
+# Per-(rule, file) budgets inside semgrep itself: a pathological file stops
+# costing after a few rule timeouts instead of eating the whole batch's
+# budget, runaway rule+file pairs are killed past the memory cap, and
+# oversized targets are skipped outright (semgrep's default, pinned here).
+SEMGREP_RULE_TIMEOUT_S = 5
+SEMGREP_TIMEOUT_THRESHOLD = 3
+SEMGREP_MAX_MEMORY_MB = 1024
+SEMGREP_MAX_TARGET_BYTES = 1_000_000
+
+# Payload limits, enforced before any hashing, writing or scanning happens.
+# Sized well above what a PR's changed files reach in practice.
+MAX_FILES_PER_SCAN = 500
+MAX_TOTAL_CONTENT_CHARS = 10_000_000
+
+# Extensions covered by the languages declared in rules.yml. Files that
+# can't match any rule (lockfiles, images, markdown, ...) are dropped before
+# they are written to the workspace or handed to semgrep. Registry scans
+# ("auto") cover many more languages, so no filtering is applied there.
+SCANNABLE_EXTENSIONS = frozenset({
+    ".java",                          # java
+    ".kt", ".kts",                    # kotlin
+    ".js", ".jsx", ".mjs", ".cjs",    # javascript
+    ".ts", ".tsx", ".mts", ".cts",    # typescript
+    ".py", ".pyi",                    # python
+    ".go",                            # go
+    ".rs",                            # rust
+})
+
+_scan_queue: asyncio.Queue | None = None
+_scan_loop: asyncio.AbstractEventLoop | None = None
+_scan_worker_task: asyncio.Task | None = None
+
 
 class FileInput(BaseModel):
     path: str
@@ -30,9 +115,16 @@ class FileInput(BaseModel):
 class ScanRequest(BaseModel):
     files: list[FileInput]
     rules_config: str = "custom"  # "custom" uses local rules.yml, "auto" uses semgrep registry
+    stream: bool = False  # NDJSON response: one finding per line, summary line last
+
 
+# Response models are msgspec Structs rather than pydantic models: they are
+# allocated once per finding and serialized straight to bytes, skipping
+# pydantic's per-field validation and jsonable_encoder pass entirely.
+# Finding holds only scalars, so gc=False keeps the (potentially thousands
+# of) instances out of the cyclic garbage collector's tracked set.
 
-class Finding(BaseModel):
+class Finding(msgspec.Struct, gc=False):
     rule_id: str
     path: str
     line: int
@@ -41,10 +133,54 @@ class Finding(BaseModel):
     category: str
 
 
-class ScanResponse(BaseModel):
+class ScanResponse(msgspec.Struct):
     findings: list[Finding]
     duration_ms: int
     files_scanned: int
+    skipped: list[str] = []  # paths semgrep gave up on (timeout, memory, size)
+
+
+_response_encoder = msgspec.json.Encoder()
+
+
+def _json_response(response: ScanResponse) -> Response:
+    return Response(
+        content=_response_encoder.encode(response),
+        media_type="application/json",
+    )
+
+
+def _scan_response(
+    stream: bool,
+    findings: list[Finding],
+    duration_ms: int,
+    files_scanned: int,
+    skipped: list[str],
+) -> Response:
+    if not stream:
+        return _json_response(ScanResponse(
+            findings=findings,
+            duration_ms=duration_ms,
+            files_scanned=files_scanned,
+            skipped=skipped,
+        ))
+
+    # NDJSON framing only: the findings are fully known before the first
+    # line goes out (they come from the shared batch scan), so this doesn't
+    # lower time-to-first-finding -- it lets clients decode large result
+    # sets line by line instead of holding one large JSON body in memory
+    def lines():
+        for finding in findings:
+            yield _response_encoder.encode(finding) + b"\n"
+        yield _response_encoder.encode(
+            {
+                "duration_ms": duration_ms,
+                "files_scanned": files_scanned,
+                "skipped": skipped,
+            }
+        ) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 class HealthResponse(BaseModel):
@@ -52,10 +188,47 @@ class HealthResponse(BaseModel):
     semgrep_version: str
 
 
-def get_semgrep_version() -> str:
+# Typed views of the semgrep JSON report declaring only the fields we read.
+# msgspec skips unknown keys at the C level, so the large ignored sections
+# (metadata, dataflow traces, paths, ...) are never materialized as Python
+# objects.
+
+class SemgrepPosition(msgspec.Struct, gc=False):
+    line: int = 0
+
+
+class SemgrepExtra(msgspec.Struct, gc=False):
+    message: str = ""
+    severity: str = "INFO"
+
+
+class SemgrepResult(msgspec.Struct, gc=False):
+    check_id: str = "unknown"
+    path: str = ""
+    start: SemgrepPosition = msgspec.field(default_factory=SemgrepPosition)
+    extra: SemgrepExtra = msgspec.field(default_factory=SemgrepExtra)
+
+
+class SemgrepError(msgspec.Struct, gc=False):
+    path: str = ""
+
+
+class SemgrepOutput(msgspec.Struct):
+    results: list[SemgrepResult] = msgspec.field(default_factory=list)
+    errors: list[SemgrepError] = msgspec.field(default_factory=list)
+
+
+_semgrep_decoder = msgspec.json.Decoder(SemgrepOutput)
+
+
+_semgrep_version: str | None = None
+_semgrep_version_lock = threading.Lock()
+
+
+def _probe_semgrep_version() -> str:
     try:
         result = subprocess.run(
-            ["semgrep", "--version"],
+            [SEMGREP_BIN, "--version", *SEMGREP_BASE_ARGS],
             capture_output=True,
             text=True,
             timeout=10,
@@ -65,17 +238,273 @@ def get_semgrep_version() -> str:
         return "unknown"
 
 
+def get_semgrep_version() -> str:
+    """The installed semgrep version, probed once per process.
+
+    The binary can't change under a running deployment, so /health serves
+    the cached value instead of forking semgrep on every probe. A failed
+    probe ("unknown") is not cached so transient failures can recover.
+    """
+    global _semgrep_version
+    if _semgrep_version is None:
+        with _semgrep_version_lock:
+            if _semgrep_version is None:
+                version = _probe_semgrep_version()
+                if version == "unknown":
+                    return version
+                _semgrep_version = version
+    return _semgrep_version
+
+
+def scan_cache_key(request: "ScanRequest") -> str:
+    """Build a cache key covering file contents and the effective rules.
+
+    Includes rules.yml's mtime and size so editing the ruleset invalidates
+    cached results for "custom" scans.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(request.rules_config.encode("utf-8"))
+    if request.rules_config != "auto":
+        signature = _rules_cache.signature()
+        if signature is not None:
+            hasher.update(f"{signature[0]}:{signature[1]}".encode("ascii"))
+    for file_input in sorted(request.files, key=lambda f: f.path):
+        hasher.update(file_input.path.encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(file_input.content.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def is_scannable(path: str) -> bool:
+    """Whether any rule in rules.yml could apply to a file at this path."""
+    _, ext = os.path.splitext(path)
+    return ext.lower() in SCANNABLE_EXTENSIONS
+
+
+# --- Content prefilter ------------------------------------------------------
+# Semgrep patterns are mostly built around fixed identifiers (eval, innerHTML,
+# subprocess, ...). For each rule we extract "witness" literals such that any
+# code the rule matches must contain at least one of them. If every rule
+# yields witnesses, an Aho-Corasick automaton over all of them lets us drop
+# files that cannot match any rule in a single pass over their content,
+# without ever invoking semgrep on them.
+
+_METAVARIABLE_RE = re.compile(r"\$\{?[A-Za-z_][A-Za-z0-9_]*\}?")
+_LITERAL_TOKEN_RE = re.compile(r"[A-Za-z][A-Za-z0-9_]{2,}")
+
+
+def _witnesses_from_pattern(pattern: str) -> set[str] | None:
+    """Literal tokens of a pattern string; all are required, so any serves."""
+    tokens = set(_LITERAL_TOKEN_RE.findall(_METAVARIABLE_RE.sub(" ", pattern)))
+    return tokens or None
+
+
+def _regex_branch_literal(branch: str) -> str | None:
+    """The exact string a regex branch matches, or None if it isn't literal.
+
+    Accepts word characters, "@" and spaces as-is plus backslash-escaped
+    punctuation (e.g. "it\\.skip"). Any bare metacharacter means the branch
+    could match text not containing it verbatim, so it proves nothing —
+    that includes escape classes like "\\d" or "\\b", where the backslash
+    makes an alphanumeric a metacharacter rather than the other way round.
+    """
+    literal = []
+    i = 0
+    while i < len(branch):
+        char = branch[i]
+        if char == "\\" and i + 1 < len(branch):
+            escaped = branch[i + 1]
+            if escaped.isalnum():
+                return None
+            literal.append(escaped)
+            i += 2
+        elif char.isalnum() or char in "_@ ":
+            literal.append(char)
+            i += 1
+        else:
+            return None
+    return "".join(literal) or None
+
+
+def _witnesses_from_regex(regex: str) -> set[str] | None:
+    """Witnesses for a regex; only alternations of literal branches qualify,
+    e.g. "(?i)(password|secret|token)" or "it\\.skip|t\\.Skip\\(\\)"."""
+    body = regex.removeprefix("(?i)")
+    if body.startswith("(") and body.endswith(")"):
+        body = body[1:-1]
+    witnesses = set()
+    for branch in body.split("|"):
+        literal = _regex_branch_literal(branch)
+        if literal is None:
+            return None
+        witnesses.add(literal)
+    return witnesses or None
+
+
+def _witnesses_from_clause(clause: dict) -> set[str] | None:
+    """Witness literals for one rule clause, or None if none can be proven.
+
+    Treats the clause keys as a conjunction (the first operand that yields
+    witnesses is sufficient). A pattern-either is a disjunction: every branch
+    must yield witnesses or the whole alternation proves nothing. Negations
+    and context operators (pattern-not, pattern-inside, ...) are ignored.
+    """
+    if not isinstance(clause, dict):
+        return None
+
+    pattern = clause.get("pattern")
+    if isinstance(pattern, str):
+        witnesses = _witnesses_from_pattern(pattern)
+        if witnesses:
+            return witnesses
+
+    pattern_regex = clause.get("pattern-regex")
+    if isinstance(pattern_regex, str):
+        witnesses = _witnesses_from_regex(pattern_regex)
+        if witnesses:
+            return witnesses
+
+    for branch_clauses in (clause.get("pattern-either"),):
+        if isinstance(branch_clauses, list):
+            witnesses = set()
+            for branch in branch_clauses:
+                branch_witnesses = _witnesses_from_clause(branch)
+                if not branch_witnesses:
+                    witnesses = None
+                    break
+                witnesses |= branch_witnesses
+            if witnesses:
+                return witnesses
+
+    sub_clauses = clause.get("patterns")
+    if isinstance(sub_clauses, list):
+        for sub_clause in sub_clauses:
+            witnesses = _witnesses_from_clause(sub_clause)
+            if witnesses:
+                return witnesses
+
+    metavariable_regex = clause.get("metavariable-regex")
+    if isinstance(metavariable_regex, dict):
+        regex = metavariable_regex.get("regex")
+        if isinstance(regex, str):
+            witnesses = _witnesses_from_regex(regex)
+            if witnesses:
+                return witnesses
+
+    return None
+
+
+def build_rule_prefilter(rules_path: Path) -> "ahocorasick.Automaton | None":
+    """Build the witness automaton, or None if any rule lacks witnesses.
+
+    A file may only be skipped when *no* rule can match it, so a single rule
+    without provable witnesses disables the prefilter entirely.
+    """
+    try:
+        rules = yaml.safe_load(rules_path.read_text(encoding="utf-8"))["rules"]
+    except Exception:
+        return None
+
+    all_witnesses: set[str] = set()
+    for rule in rules:
+        witnesses = _witnesses_from_clause(rule)
+        if not witnesses:
+            return None
+        all_witnesses |= witnesses
+
+    automaton = ahocorasick.Automaton()
+    for witness in all_witnesses:
+        automaton.add_word(witness.lower(), witness)
+    automaton.make_automaton()
+    return automaton
+
+
+class RulesCache:
+    """Process-wide cache of everything derived from rules.yml.
+
+    One instance is shared by all requests so the rule file is parsed and the
+    prefilter automaton built once, not per scan. State is revalidated
+    against the file's (mtime, size) signature, so editing the rules takes
+    effect without a restart. The stat() itself is rate-limited: every scan
+    consults the cache several times (cache key, prefilter, existence), and
+    rule edits are rare, so re-checking at most every couple of seconds is
+    plenty fresh.
+    """
+
+    STAT_TTL_S = 2.0
+
+    def __init__(self, rules_path: Path):
+        self.rules_path = rules_path
+        self._lock = threading.Lock()
+        self._signature: tuple[int, int] | None = None
+        self._prefilter: "ahocorasick.Automaton | None" = None
+        self._loaded = False
+        self._checked_at = 0.0
+
+    def _refresh_locked(self) -> None:
+        now = time.monotonic()
+        if self._loaded and now - self._checked_at < self.STAT_TTL_S:
+            return
+        try:
+            stat = self.rules_path.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if not self._loaded or signature != self._signature:
+            self._signature = signature
+            self._prefilter = build_rule_prefilter(self.rules_path) if signature else None
+            self._loaded = True
+        self._checked_at = now
+
+    def signature(self) -> tuple[int, int] | None:
+        """The rule file's (mtime_ns, size), or None if it is missing."""
+        with self._lock:
+            self._refresh_locked()
+            return self._signature
+
+    def exists(self) -> bool:
+        return self.signature() is not None
+
+    def prefilter(self) -> "ahocorasick.Automaton | None":
+        with self._lock:
+            self._refresh_locked()
+            return self._prefilter
+
+
+_rules_cache = RulesCache(RULES_PATH)
+
+
+def may_match_rules(content: str) -> bool:
+    """Whether the content contains any rule witness (prefilter gate)."""
+    prefilter = _rules_cache.prefilter()
+    if prefilter is None:
+        return True
+    return next(prefilter.iter(content.lower()), None) is not None
+
+
+# Severity table built once at import, with lowercase spellings precomputed
+# so the common path is a single dict hit without calling .upper()
+_SEVERITY_MAP = {
+    "ERROR": "error",
+    "WARNING": "warning",
+    "INFO": "info",
+}
+_SEVERITY_MAP.update({key.lower(): value for key, value in _SEVERITY_MAP.items()})
+
+
 def map_severity(semgrep_severity: str) -> str:
-    mapping = {
-        "ERROR": "error",
-        "WARNING": "warning",
-        "INFO": "info",
-    }
-    return mapping.get(semgrep_severity.upper(), "info")
+    severity = _SEVERITY_MAP.get(semgrep_severity)
+    if severity is not None:
+        return severity
+    return _SEVERITY_MAP.get(semgrep_severity.upper(), "info")
 
 
-def map_category(rule_id: str) -> str:
-    security_rules = {
+# Category dispatch table, built once at import instead of rebuilding the
+# rule-id set on every call. Unknown rules default to "security".
+_RULE_CATEGORIES: dict[str, str] = {
+    rule_id: "security"
+    for rule_id in (
         "hardcoded-secret-generic", "sql-string-concat", "weak-crypto-md5",
         "weak-crypto-sha1", "js-eval-usage", "js-innerhtml", "python-exec",
         "python-subprocess-shell", "go-sql-format", "rust-unsafe-block",
@@ -84,118 +513,317 @@ def map_category(rule_id: str) -> str:
         "ssrf-python", "ssrf-node",
         "insecure-deserialize-python", "insecure-deserialize-java",
         "java-unsafe-reflection", "log-injection",
-    }
-    if rule_id in security_rules:
-        return "security"
-    if rule_id == "test-todo-skip":
-        return "quality"
-    return "security"
-
-
-def parse_semgrep_output(output: dict[str, Any]) -> list[Finding]:
-    findings: list[Finding] = []
-    for result in output.get("results", []):
-        check_id = result.get("check_id", "unknown")
-        # Strip path prefix if present (e.g., "rules.hardcoded-secret-generic")
-        if "." in check_id:
-            check_id = check_id.rsplit(".", 1)[-1]
-
-        findings.append(Finding(
-            rule_id=check_id,
-            path=result.get("path", ""),
-            line=result.get("start", {}).get("line", 0),
-            message=result.get("extra", {}).get("message", ""),
-            severity=map_severity(result.get("extra", {}).get("severity", "INFO")),
-            category=map_category(check_id),
-        ))
+    )
+}
+_RULE_CATEGORIES["test-todo-skip"] = "quality"
 
-    return findings
 
+def map_category(rule_id: str) -> str:
+    return _RULE_CATEGORIES.get(rule_id, "security")
+
+
+def _findings_from_results(results: list[SemgrepResult]) -> list[Finding]:
+    # rsplit also covers the no-prefix case ("js-eval-usage" stays as-is),
+    # so each result is destructured into a Finding in one pass
+    return [
+        Finding(
+            rule_id=(rule_id := result.check_id.rsplit(".", 1)[-1]),
+            path=result.path,
+            line=result.start.line,
+            message=result.extra.message,
+            severity=map_severity(result.extra.severity),
+            category=map_category(rule_id),
+        )
+        for result in results
+    ]
+
+
+def parse_semgrep_output(output: bytes) -> list[Finding]:
+    return _findings_from_results(_semgrep_decoder.decode(output).results)
+
+
+def _ensure_scan_worker() -> asyncio.Queue:
+    """Return the scan queue, starting the batching worker on first use."""
+    global _scan_queue, _scan_loop, _scan_worker_task
+    loop = asyncio.get_running_loop()
+    if (
+        _scan_queue is None
+        or _scan_loop is not loop
+        or _scan_worker_task is None
+        or _scan_worker_task.done()
+    ):
+        _scan_queue = asyncio.Queue()
+        _scan_loop = loop
+        _scan_worker_task = loop.create_task(_scan_worker())
+    return _scan_queue
+
+
+async def _scan_worker() -> None:
+    """Drain the scan queue, merging requests that arrive close together.
+
+    Each batch is written to one tmpdir (namespaced per request) and scanned
+    with a single semgrep invocation; results are routed back to the waiting
+    callers via their futures.
+    """
+    queue = _scan_queue
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        # Requests with different rule configs cannot share an invocation
+        groups: dict[str, list[tuple[ScanRequest, asyncio.Future]]] = {}
+        for pending in batch:
+            groups.setdefault(pending[0].rules_config, []).append(pending)
+        for rules_config, group in groups.items():
+            # A batch must never take the worker down with it: fail its
+            # callers and keep draining the queue
+            try:
+                await _run_scan_batch(rules_config, group)
+            except Exception as e:
+                _fail_batch(group, HTTPException(status_code=500, detail=str(e)))
+
+
+def _write_scan_file(write: tuple[Path, bytes]) -> None:
+    # Raw os-level write: one open/write/close per file with no buffered-IO
+    # stack in between. No fsync -- these are scratch files whose durability
+    # is irrelevant; they are deleted as soon as the batch is scanned.
+    file_path, content = write
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
-@app.get("/health", response_model=HealthResponse)
-async def health():
-    return HealthResponse(
-        status="ok",
-        semgrep_version=get_semgrep_version(),
-    )
 
+def _fail_batch(group: list[tuple[ScanRequest, asyncio.Future]], exc: Exception) -> None:
+    for _, future in group:
+        if not future.done():
+            future.set_exception(exc)
 
-@app.post("/api/scan", response_model=ScanResponse)
-async def scan(request: ScanRequest):
-    if not request.files:
-        return ScanResponse(findings=[], duration_ms=0, files_scanned=0)
 
-    tmpdir = tempfile.mkdtemp(prefix="semgrep-scan-")
-    start_time = time.time()
+async def _run_scan_batch(rules_config: str, group: list[tuple[ScanRequest, asyncio.Future]]) -> None:
+    tmpdir = None
 
     try:
-        # Write files to temporary directory
-        for file_input in request.files:
-            file_path = Path(tmpdir) / file_input.path
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            file_path.write_text(file_input.content, encoding="utf-8")
+        # Inside the try so a transient failure (e.g. ENOSPC on the tmpfs
+        # workspace) fails this batch instead of killing the worker
+        tmpdir = tempfile.mkdtemp(prefix="semgrep-scan-", dir=SCAN_TMP_DIR)
+
+        # Write each request's files under a unique subdirectory so findings
+        # can be routed back to the right caller afterwards
+        request_ids: dict[str, asyncio.Future] = {}
+        created_dirs: set[Path] = set()
+        writes: list[tuple[Path, bytes]] = []
+        for request, future in group:
+            request_id = uuid.uuid4().hex
+            request_ids[request_id] = future
+            for file_input in request.files:
+                file_path = Path(tmpdir) / request_id / file_input.path
+                # PRs typically touch many files per directory; only hit the
+                # filesystem for parents we haven't created yet
+                parent = file_path.parent
+                if parent not in created_dirs:
+                    parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(parent)
+                # Encode once up front; write_bytes then skips the
+                # TextIOWrapper layer entirely
+                writes.append((file_path, file_input.content.encode("utf-8")))
+
+        if len(writes) >= PARALLEL_WRITE_MIN_FILES:
+            # Directories already exist, so the writes are independent
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(
+                loop.run_in_executor(_write_pool, _write_scan_file, write)
+                for write in writes
+            ))
+        else:
+            for write in writes:
+                _write_scan_file(write)
 
         # Determine rules config
-        if request.rules_config == "auto":
+        if rules_config == "auto":
             config_arg = "auto"
         else:
-            if not RULES_PATH.exists():
-                raise HTTPException(status_code=500, detail="rules.yml not found")
-            config_arg = str(RULES_PATH)
+            if not _rules_cache.exists():
+                _fail_batch(group, HTTPException(status_code=500, detail="rules.yml not found"))
+                return
+            config_arg = str(_rules_cache.rules_path)
 
         # Run semgrep
         cmd = [
-            "semgrep",
+            SEMGREP_BIN,
             "--config", config_arg,
             "--json",
             "--no-git-ignore",
             "--quiet",
+            "--timeout", str(SEMGREP_RULE_TIMEOUT_S),
+            "--timeout-threshold", str(SEMGREP_TIMEOUT_THRESHOLD),
+            "--max-memory", str(SEMGREP_MAX_MEMORY_MB),
+            "--max-target-bytes", str(SEMGREP_MAX_TARGET_BYTES),
+            *SEMGREP_BASE_ARGS,
             tmpdir,
         ]
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=60,
+        # Run semgrep without blocking the event loop, so /health and new
+        # requests keep being served while a batch scans. Output is captured
+        # as raw bytes: semgrep reports can be multi-MB and msgspec decodes
+        # them directly without an intermediate UTF-8 str.
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
+        scan_timeout = min(SCAN_TIMEOUT_S, SCAN_TIMEOUT_BASE_S + len(writes))
+        try:
+            proc_stdout, proc_stderr = await asyncio.wait_for(
+                proc.communicate(), timeout=scan_timeout
+            )
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.communicate()
+            _fail_batch(group, HTTPException(status_code=504, detail="Semgrep scan timed out"))
+            return
 
         # Semgrep exits with code 1 when findings are present, which is expected
-        if result.returncode not in (0, 1):
-            raise HTTPException(
+        if proc.returncode not in (0, 1):
+            stderr = proc_stderr.decode("utf-8", errors="replace")
+            _fail_batch(group, HTTPException(
                 status_code=500,
-                detail=f"Semgrep error: {result.stderr[:500]}",
-            )
+                detail=f"Semgrep error: {stderr[:500]}",
+            ))
+            return
 
         # Parse output
         try:
-            output = json.loads(result.stdout)
-        except json.JSONDecodeError:
-            raise HTTPException(
+            report = _semgrep_decoder.decode(proc_stdout)
+        except msgspec.DecodeError:
+            stdout = proc_stdout.decode("utf-8", errors="replace")
+            _fail_batch(group, HTTPException(
                 status_code=500,
-                detail=f"Failed to parse Semgrep output: {result.stdout[:200]}",
+                detail=f"Failed to parse Semgrep output: {stdout[:200]}",
+            ))
+            return
+
+        # Route findings back per request, normalizing paths (remove the
+        # tmpdir prefix and the per-request namespace)
+        findings_by_request: dict[str, list[Finding]] = {
+            request_id: [] for request_id in request_ids
+        }
+        workspace_prefix = tmpdir + os.sep
+        for finding in _findings_from_results(report.results):
+            # removeprefix is a no-op for already-relative paths, so no
+            # per-finding startswith/lstrip branching is needed
+            request_id, _, rel_path = (
+                finding.path.removeprefix(workspace_prefix).partition(os.sep)
             )
+            bucket = findings_by_request.get(request_id)
+            if bucket is None:
+                continue
+            finding.path = rel_path
+            bucket.append(finding)
+
+        # Files semgrep gave up on (rule timeouts, memory cap, oversize
+        # targets) surface in the errors array; route them the same way so
+        # each caller learns which of its files went unscanned
+        skipped_by_request: dict[str, list[str]] = {
+            request_id: [] for request_id in request_ids
+        }
+        for error in report.errors:
+            request_id, _, rel_path = (
+                error.path.removeprefix(workspace_prefix).partition(os.sep)
+            )
+            skipped = skipped_by_request.get(request_id)
+            if skipped is None or not rel_path or rel_path in skipped:
+                continue
+            skipped.append(rel_path)
 
-        findings = parse_semgrep_output(output)
+        for request_id, future in request_ids.items():
+            if not future.done():
+                future.set_result(
+                    (findings_by_request[request_id], skipped_by_request[request_id])
+                )
 
-        # Normalize paths (remove tmpdir prefix)
-        for finding in findings:
-            if finding.path.startswith(tmpdir):
-                finding.path = finding.path[len(tmpdir):].lstrip("/").lstrip("\\")
+    except Exception as e:
+        _fail_batch(group, HTTPException(status_code=500, detail=str(e)))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
-        duration_ms = int((time.time() - start_time) * 1000)
 
-        return ScanResponse(
-            findings=findings,
-            duration_ms=duration_ms,
-            files_scanned=len(request.files),
+@app.get("/health", response_model=HealthResponse)
+async def health():
+    return HealthResponse(
+        status="ok",
+        semgrep_version=get_semgrep_version(),
+    )
+
+
+@app.post("/api/scan")
+async def scan(request: ScanRequest):
+    if len(request.files) > MAX_FILES_PER_SCAN:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many files: {len(request.files)} (max {MAX_FILES_PER_SCAN})",
+        )
+    total_chars = sum(len(f.content) for f in request.files)
+    if total_chars > MAX_TOTAL_CONTENT_CHARS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Payload too large: {total_chars} chars (max {MAX_TOTAL_CONTENT_CHARS})",
+        )
+
+    if request.rules_config != "auto":
+        scannable = [
+            f for f in request.files
+            if is_scannable(f.path) and may_match_rules(f.content)
+        ]
+        if len(scannable) != len(request.files):
+            request = request.model_copy(update={"files": scannable})
+
+    if not request.files:
+        return _scan_response(request.stream, [], 0, 0, [])
+
+    start_time = time.time()
+
+    cache_key = scan_cache_key(request)
+    with _scan_cache_lock:
+        cached = _scan_cache.get(cache_key)
+    if cached is not None:
+        cached_findings, cached_skipped = cached
+        return _scan_response(
+            request.stream,
+            [msgspec.structs.replace(finding) for finding in cached_findings],
+            int((time.time() - start_time) * 1000),
+            len(request.files),
+            list(cached_skipped),
         )
 
-    except HTTPException:
-        raise
-    except subprocess.TimeoutExpired:
+    queue = _ensure_scan_worker()
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    await queue.put((request, future))
+
+    try:
+        findings, skipped = await asyncio.wait_for(future, timeout=SCAN_TIMEOUT_S)
+    except asyncio.TimeoutError:
         raise HTTPException(status_code=504, detail="Semgrep scan timed out")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    with _scan_cache_lock:
+        _scan_cache[cache_key] = (
+            [msgspec.structs.replace(finding) for finding in findings],
+            list(skipped),
+        )
+
+    duration_ms = int((time.time() - start_time) * 1000)
+
+    return _scan_response(request.stream, findings, duration_ms, len(request.files), skipped)
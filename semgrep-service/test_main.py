@@ -2,6 +2,7 @@
 Tests for the Semgrep microservice API.
 """
 
+import json
 import os
 import tempfile
 from pathlib import Path
@@ -10,7 +11,10 @@ from unittest.mock import patch, MagicMock
 import pytest
 from fastapi.testclient import TestClient
 
-from main import app, parse_semgrep_output, map_severity, map_category
+import main as main_module
+from main import app, parse_semgrep_output, map_severity, map_category, scan_cache_key
+from main import ScanRequest, FileInput, is_scannable, build_rule_prefilter, RulesCache
+from main import _witnesses_from_clause
 
 client = TestClient(app)
 
@@ -92,17 +96,26 @@ class TestScanEndpoint:
 
     def test_scan_multiple_files(self):
         """Scanning multiple files should report correct files_scanned count."""
+        # Contents mention rule witnesses so the prefilter keeps all three
         response = client.post("/api/scan", json={
             "files": [
-                {"path": "a.js", "content": "const x = 1;"},
-                {"path": "b.js", "content": "const y = 2;"},
-                {"path": "c.py", "content": "x = 1"},
+                {"path": "a.js", "content": "// no eval here\nconst x = 1;"},
+                {"path": "b.js", "content": "// innerHTML untouched\nconst y = 2;"},
+                {"path": "c.py", "content": "# not using exec\nx = 1"},
             ],
         })
         assert response.status_code == 200
         data = response.json()
         assert data["files_scanned"] == 3
 
+    def test_scan_reports_skipped_files(self):
+        """skipped lists files semgrep gave up on; empty for a normal scan."""
+        response = client.post("/api/scan", json={
+            "files": [{"path": "ok.js", "content": "eval(x);"}],
+        })
+        assert response.status_code == 200
+        assert response.json()["skipped"] == []
+
     def test_scan_returns_duration(self):
         """Scan should report execution time."""
         response = client.post("/api/scan", json={
@@ -112,6 +125,60 @@ class TestScanEndpoint:
         data = response.json()
         assert data["duration_ms"] >= 0
 
+    def test_scan_survives_workspace_failure(self):
+        """A failed mkdtemp fails that batch fast; the worker keeps serving."""
+        with patch("main.tempfile.mkdtemp", side_effect=OSError("No space left on device")):
+            response = client.post("/api/scan", json={
+                "files": [{"path": "a.js", "content": "eval(x);"}],
+            })
+        assert response.status_code == 500
+        assert "No space left" in response.json()["detail"]
+
+        # The next request must reach semgrep again, not time out on a dead worker
+        response = client.post("/api/scan", json={
+            "files": [{"path": "a.js", "content": "eval(x);"}],
+        })
+        assert response.status_code != 504
+
+    def test_scan_rejects_too_many_files(self):
+        files = [
+            {"path": f"f{i}.js", "content": "const x = 1;"}
+            for i in range(main_module.MAX_FILES_PER_SCAN + 1)
+        ]
+        response = client.post("/api/scan", json={"files": files})
+        assert response.status_code == 413
+
+    def test_scan_rejects_oversize_content(self):
+        with patch.object(main_module, "MAX_TOTAL_CONTENT_CHARS", 10):
+            response = client.post("/api/scan", json={
+                "files": [{"path": "big.js", "content": "x" * 100}],
+            })
+        assert response.status_code == 413
+
+    def test_scan_skips_non_scannable_files(self):
+        """Files no rule can match should not reach semgrep at all."""
+        response = client.post("/api/scan", json={
+            "files": [
+                {"path": "README.md", "content": "# docs"},
+                {"path": "logo.png", "content": "not really an image"},
+            ],
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["findings"] == []
+        assert data["files_scanned"] == 0
+
+    def test_scan_stream_returns_ndjson(self):
+        """stream=true responds with one JSON object per line, summary last."""
+        response = client.post("/api/scan", json={
+            "files": [{"path": "notes.md", "content": "# nothing to scan"}],
+            "stream": True,
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert lines[-1] == {"duration_ms": 0, "files_scanned": 0, "skipped": []}
+
     def test_scan_paths_are_relative(self):
         """Finding paths should be relative, not absolute tmp paths."""
         response = client.post("/api/scan", json={
@@ -129,6 +196,111 @@ class TestScanEndpoint:
             assert not finding["path"].startswith("C:\\")
 
 
+class TestRulePrefilter:
+    def test_witnesses_from_simple_pattern(self):
+        witnesses = _witnesses_from_clause({"pattern": "eval($X)"})
+        assert witnesses == {"eval"}
+
+    def test_witnesses_ignore_metavariables(self):
+        witnesses = _witnesses_from_clause({"pattern": "$X.innerHTML = $Y"})
+        assert witnesses == {"innerHTML"}
+
+    def test_pattern_either_requires_all_branches(self):
+        # One branch without literals means the alternation proves nothing
+        witnesses = _witnesses_from_clause({
+            "pattern-either": [
+                {"pattern": "eval($X)"},
+                {"pattern": '$VAR = "..."'},
+            ],
+        })
+        assert witnesses is None
+
+    def test_pattern_either_unions_branches(self):
+        witnesses = _witnesses_from_clause({
+            "pattern-either": [
+                {"pattern": "eval($X)"},
+                {"pattern": "exec($X)"},
+            ],
+        })
+        assert witnesses == {"eval", "exec"}
+
+    def test_pattern_regex_literal_alternation(self):
+        witnesses = _witnesses_from_clause({
+            "pattern-regex": r"@Disabled|it\.skip|t\.Skip\(\)",
+        })
+        assert witnesses == {"@Disabled", "it.skip", "t.Skip()"}
+
+    def test_pattern_regex_with_bare_metachars_proves_nothing(self):
+        assert _witnesses_from_clause({"pattern-regex": r"eval.*\("}) is None
+
+    def test_pattern_regex_with_escape_class_proves_nothing(self):
+        # \d is a metacharacter, not an escaped literal "d"
+        assert _witnesses_from_clause({"pattern-regex": r"secret\d|token"}) is None
+
+    def test_metavariable_regex_alternation(self):
+        witnesses = _witnesses_from_clause({
+            "metavariable-regex": {
+                "metavariable": "$VAR",
+                "regex": "(?i)(password|secret|token)",
+            },
+        })
+        assert witnesses == {"password", "secret", "token"}
+
+    def test_build_prefilter_and_match(self, tmp_path):
+        rules_path = tmp_path / "rules.yml"
+        rules_path.write_text(
+            "rules:\n"
+            "  - id: js-eval-usage\n"
+            "    pattern: eval($X)\n"
+            "    message: no eval\n"
+            "    severity: ERROR\n"
+            "    languages: [javascript]\n"
+        )
+        automaton = build_rule_prefilter(rules_path)
+        assert automaton is not None
+        assert next(automaton.iter("return eval(input);"), None) is not None
+        assert next(automaton.iter("return add(a, b);"), None) is None
+
+    def test_build_prefilter_disabled_without_witnesses(self, tmp_path):
+        rules_path = tmp_path / "rules.yml"
+        rules_path.write_text(
+            "rules:\n"
+            "  - id: anything-goes\n"
+            "    pattern: $A = $B\n"
+            "    message: m\n"
+            "    severity: INFO\n"
+            "    languages: [python]\n"
+        )
+        assert build_rule_prefilter(rules_path) is None
+
+    def test_build_prefilter_activates_on_shipped_rules(self):
+        """Every rule in the real rules.yml must yield witnesses, or the
+        prefilter is silently disabled in production."""
+        automaton = build_rule_prefilter(main_module.RULES_PATH)
+        assert automaton is not None
+        # Spot-check witnesses from pattern, metavariable-regex and
+        # pattern-regex rules (matching is done on lowercased content)
+        for content in ("return eval(x);", "password = 'x'", "t.skip()"):
+            assert next(automaton.iter(content.lower()), None) is not None
+        assert next(automaton.iter("const x = 1;"), None) is None
+
+    def test_build_prefilter_disabled_on_missing_file(self, tmp_path):
+        assert build_rule_prefilter(tmp_path / "missing.yml") is None
+
+    def test_rules_cache_stats_at_most_once_per_ttl(self, tmp_path):
+        rules_path = tmp_path / "rules.yml"
+        rules_path.write_text("rules: []\n")
+        cache = RulesCache(rules_path)
+        signature = cache.signature()
+        assert signature is not None
+
+        # Within the TTL the deletion goes unnoticed; expiring it re-stats
+        rules_path.unlink()
+        assert cache.signature() == signature
+        cache._checked_at = 0.0
+        assert cache.signature() is None
+
+
 class TestHelpers:
     def test_map_severity(self):
         assert map_severity("ERROR") == "error"
@@ -144,8 +316,35 @@ class TestHelpers:
     def test_map_category_quality(self):
         assert map_category("test-todo-skip") == "quality"
 
+    def test_is_scannable(self):
+        assert is_scannable("src/app.ts")
+        assert is_scannable("Main.java")
+        assert is_scannable("pkg/handler.go")
+        assert not is_scannable("README.md")
+        assert not is_scannable("package-lock.json")
+        assert not is_scannable("assets/logo.png")
+
+    def test_scan_cache_key_is_order_independent(self):
+        a = ScanRequest(files=[
+            FileInput(path="a.js", content="const x = 1;"),
+            FileInput(path="b.js", content="const y = 2;"),
+        ])
+        b = ScanRequest(files=list(reversed(a.files)))
+        assert scan_cache_key(a) == scan_cache_key(b)
+
+    def test_scan_cache_key_varies_with_content(self):
+        a = ScanRequest(files=[FileInput(path="a.js", content="const x = 1;")])
+        b = ScanRequest(files=[FileInput(path="a.js", content="const x = 2;")])
+        assert scan_cache_key(a) != scan_cache_key(b)
+
+    def test_scan_cache_key_varies_with_rules_config(self):
+        files = [FileInput(path="a.js", content="const x = 1;")]
+        a = ScanRequest(files=files, rules_config="custom")
+        b = ScanRequest(files=files, rules_config="auto")
+        assert scan_cache_key(a) != scan_cache_key(b)
+
     def test_parse_semgrep_output_empty(self):
-        findings = parse_semgrep_output({"results": []})
+        findings = parse_semgrep_output(json.dumps({"results": []}).encode())
         assert findings == []
 
     def test_parse_semgrep_output_with_results(self):
@@ -163,7 +362,7 @@ class TestHelpers:
                 }
             ]
         }
-        findings = parse_semgrep_output(output)
+        findings = parse_semgrep_output(json.dumps(output).encode())
         assert len(findings) == 1
         assert findings[0].rule_id == "js-eval-usage"
         assert findings[0].line == 5